@@ -1,17 +1,50 @@
 import os
-import requests
-from pathlib import Path
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import FileResponse, JSONResponse
+import re
+import asyncio
+import bisect
+import hashlib
+import io
+import time
+import uuid
+import functools
+import atexit
+import logging
+import logging.handlers
+import queue
 import tempfile
-import pdfplumber
+import httpx
+import orjson
+from collections import OrderedDict
+from typing import List, Union
+from fastapi import FastAPI, UploadFile, File, Form, Request, Response
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
+import pypdfium2 as pdfium
 from fastapi.middleware.cors import CORSMiddleware
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# --- Logging ---
+# Records are queued and written by a listener thread, so request handlers
+# never block on stderr
+logger = logging.getLogger("ats")
+# `python main.py` imports this module twice (as __main__ and as main for
+# uvicorn), so only the first import sets up the handler and listener
+if not logger.handlers:
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+    _log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    _log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
 # --- API Keys ---
 AFFINDA_API_KEY = os.getenv("AFFINDA_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -20,16 +53,78 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if GEMINI_API_KEY:
     try:
         genai.configure(api_key=GEMINI_API_KEY)
-        print("✅ Gemini API configured successfully")
+        logger.info("✅ Gemini API configured successfully")
     except Exception as e:
-        print(f"❌ Gemini configuration failed: {e}")
+        logger.error("❌ Gemini configuration failed: %s", e)
         GEMINI_API_KEY = None  # Disable Gemini if configuration fails
 
 # Affinda API configuration
-AFFINDA_API_URL = "https://api.affinda.com/v2/resumes"
+AFFINDA_BASE_URL = "https://api.affinda.com"
+AFFINDA_RESUMES_PATH = "/v2/resumes"
 AFFINDA_HEADERS = {"Authorization": f"Bearer {AFFINDA_API_KEY}"}
 
-app = FastAPI(title="AI Resume ATS Optimizer")
+# Shared Affinda client so repeat calls reuse pooled keep-alive (HTTP/2
+# where offered) connections instead of paying a TCP + TLS handshake per
+# request; connection failures are retried by the transport
+AFFINDA_CLIENT = httpx.AsyncClient(
+    base_url=AFFINDA_BASE_URL,
+    headers=AFFINDA_HEADERS,
+    # Uploads can take a while to parse, but a connection that doesn't open
+    # in a few seconds won't; fail it fast so the transport retry kicks in
+    timeout=httpx.Timeout(60, connect=5),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+    )
+)
+
+# Cap in-flight upstream calls so bursts queue here instead of tripping
+# provider rate limits; tune to the account tier
+AFFINDA_MAX_CONCURRENCY = int(os.getenv("AFFINDA_MAX_CONCURRENCY", "20"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "10"))
+_affinda_semaphore = asyncio.Semaphore(AFFINDA_MAX_CONCURRENCY)
+_gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+# --- Upstream Retries ---
+# Rate limits and transient provider errors are retried with jittered
+# exponential backoff; callers hold their semaphore slot while backing off
+# so retries don't add to the pressure on a throttled provider
+MAX_API_ATTEMPTS = 3
+RETRY_AFTER_MAX_SECONDS = 30
+# An upload is only resent when Affinda cannot have accepted it: the request
+# never left the pool, or it was refused outright. Read/write timeouts and
+# other 5xx may follow a stored (and billed) parse, so they are not retried.
+# Connect failures are left to the transport's own retries
+AFFINDA_RETRY_STATUSES = {429, 503}
+GEMINI_RETRY_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+
+class TransientAPIError(Exception):
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+AFFINDA_RETRY_ERRORS = (TransientAPIError, httpx.PoolTimeout)
+
+def _retry_after_seconds(response: httpx.Response):
+    # Only the delta-seconds form is honoured; an HTTP-date falls back to backoff
+    try:
+        return min(float(response.headers["Retry-After"]), RETRY_AFTER_MAX_SECONDS)
+    except (KeyError, ValueError):
+        return None
+
+_backoff = wait_exponential_jitter(initial=1, max=10)
+
+def _wait_for_retry(retry_state):
+    retry_after = getattr(retry_state.outcome.exception(), "retry_after", None)
+    return retry_after if retry_after is not None else _backoff(retry_state)
+
+app = FastAPI(title="AI Resume ATS Optimizer", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -38,41 +133,155 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Content-hash caches ---
+# Results are keyed on the file contents, so the same resume uploaded again
+# is recognised whatever it is called.
+CACHE_MAX_ENTRIES = 256
+_text_cache = OrderedDict()
+_affinda_cache = OrderedDict()
+_analysis_cache = OrderedDict()
+
+def new_digest():
+    return hashlib.blake2b(digest_size=16)
+
+def file_digest(file_path: str):
+    h = new_digest()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _cache_get(cache: OrderedDict, key: str):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def _cache_put(cache: OrderedDict, key: str, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+
 # --- PDF Text Extraction ---
-def extract_text_from_pdf(pdf_path: str):
+def extract_text_from_pdf(source: Union[str, bytes, io.BytesIO]):
+    """
+    Extract text from a PDF given as a path or as the in-memory upload body
+    """
+    if isinstance(source, io.BytesIO):
+        source = source.getvalue()
+    try:
+        if isinstance(source, (bytes, bytearray)):
+            digest = hashlib.blake2b(source, digest_size=16).hexdigest()
+        else:
+            digest = file_digest(source)
+    except OSError as e:
+        logger.warning("PDF extraction failed: %s", e)
+        return ""
+    cached = _cache_get(_text_cache, digest)
+    if cached is not None:
+        return cached
+    text = _extract_text_uncached(source)
+    _cache_put(_text_cache, digest, text)
+    return text
+
+def _extract_text_uncached(source: Union[str, bytes]):
+    text = _extract_text_pdfium(source)
+    if not text:
+        # PDFium found no text layer; retry with pdfplumber's layout engine
+        text = _extract_text_pdfplumber(source)
+    return text
+
+def _extract_text_pdfium(source: Union[str, bytes]):
     text = ""
     try:
-        with pdfplumber.open(pdf_path) as pdf:
+        pdf = pdfium.PdfDocument(source)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                page_text = textpage.get_text_range()
+                # Release native handles now rather than waiting for GC
+                textpage.close()
+                page.close()
+                if page_text:
+                    text += page_text.replace("\r\n", "\n") + "\n"
+        finally:
+            pdf.close()
+    except Exception as e:
+        logger.warning("PDFium extraction failed: %s", e)
+    return text.strip()
+
+@functools.cache
+def _pdfplumber():
+    # pdfplumber drags in pdfminer and Pillow; only load it when the fallback is hit
+    import pdfplumber
+    return pdfplumber
+
+def _extract_text_pdfplumber(source: Union[str, bytes]):
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    text = ""
+    try:
+        with _pdfplumber().open(source) as pdf:
             for page in pdf.pages:
                 page_text = page.extract_text()
                 if page_text:
                     text += page_text + "\n"
     except Exception as e:
-        print(f"PDF extraction failed: {e}")
+        logger.warning("PDF extraction failed: %s", e)
     return text.strip()
 
 # --- Affinda API Resume Parsing ---
-def parse_resume_with_affinda(file_path: str):
+@retry(
+    stop=stop_after_attempt(MAX_API_ATTEMPTS),
+    wait=_wait_for_retry,
+    retry=retry_if_exception_type(AFFINDA_RETRY_ERRORS),
+    reraise=True
+)
+async def _post_resume_to_affinda(filename: str, content: bytes):
+    files = {"file": (filename, content, "application/pdf")}
+    response = await AFFINDA_CLIENT.post(AFFINDA_RESUMES_PATH, files=files)
+    if response.status_code in AFFINDA_RETRY_STATUSES:
+        raise TransientAPIError(
+            f"Affinda API error {response.status_code}: {response.text}",
+            _retry_after_seconds(response)
+        )
+    return response
+
+async def parse_resume_with_affinda(filename: str, content: bytes, digest: str = None):
     if not AFFINDA_API_KEY:
         return {"error": "Affinda API key not configured"}
 
     try:
-        with open(file_path, "rb") as file:
-            files = {"file": (Path(file_path).name, file, "application/pdf")}
-            response = requests.post(
-                AFFINDA_API_URL,
-                headers=AFFINDA_HEADERS,
-                files=files,
-                timeout=60
-            )
+        if digest is None:
+            digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+        cached = _cache_get(_affinda_cache, digest)
+        if cached is not None:
+            return cached
+
+        async with _affinda_semaphore:
+            response = await _post_resume_to_affinda(filename, content)
         if response.status_code == 201:
-            return response.json()
+            data = orjson.loads(response.content)
+            _cache_put(_affinda_cache, digest, data)
+            return data
         else:
             return {"error": f"Affinda API error {response.status_code}: {response.text}"}
     except Exception as e:
         return {"error": str(e)}
 
 # --- Calculate ATS Score from Affinda Data ---
+# Skills density bands: fewer than 5 skills, 5-9 skills, 10 or more
+SKILL_DENSITY_BANDS = (5, 10)
+SKILL_DENSITY_BONUS = (0, 2, 5)
+
+# (Affinda key, section name, points per entry, section cap)
+SECTION_SCORING_RULES = (
+    ("education", "education", 5, 20),
+    ("workExperience", "experience", 5, 25),
+    ("skills", "skills", 1.5, 15),
+)
+
 def calculate_ats_score_from_affinda(affinda_data: dict):
     """
     Calculate ATS score based on Affinda parsed data
@@ -81,6 +290,7 @@ def calculate_ats_score_from_affinda(affinda_data: dict):
         return {
             "score": 0,
             "sections_found": [],
+            "counts": {name: 0 for _, name, _, _ in SECTION_SCORING_RULES},
             "has_contact_info": False,
             "note": "Affinda parsing failed",
             "details": affinda_data
@@ -88,29 +298,24 @@ def calculate_ats_score_from_affinda(affinda_data: dict):
     
     # Get the actual data from Affinda response
     data = affinda_data  # The main response IS the data
+
+    # Normalize the list fields once; everything below reads these
+    section_items = {name: data.get(key) or [] for key, name, _, _ in SECTION_SCORING_RULES}
+    education = section_items["education"]
+    work_experience = section_items["experience"]
+    skills = section_items["skills"]
+    skill_names = [skill["name"] for skill in skills if skill.get("name")]
+    skills_count = len(skills)
     
     score = 50.0  # Base score
     
-    # Extract sections and calculate score
+    # Education (20), experience (25) and skills (15) sections
     sections_found = []
-    
-    # Education section (20 points)
-    if data.get("education"):
-        sections_found.append("education")
-        education_count = len(data["education"])
-        score += min(education_count * 5, 20)
-    
-    # Work Experience section (25 points)
-    if data.get("workExperience"):
-        sections_found.append("experience")
-        experience_count = len(data["workExperience"])
-        score += min(experience_count * 5, 25)
-    
-    # Skills section (15 points)
-    if data.get("skills"):
-        sections_found.append("skills")
-        skills_count = len(data["skills"])
-        score += min(skills_count * 1.5, 15)
+    for _, name, points, cap in SECTION_SCORING_RULES:
+        items = section_items[name]
+        if items:
+            sections_found.append(name)
+            score += min(len(items) * points, cap)
     
     # Summary/Objective section (10 points)
     if data.get("summary") or data.get("objective"):
@@ -132,28 +337,21 @@ def calculate_ats_score_from_affinda(affinda_data: dict):
         score += min(experience_years, 5)
     
     # Skills density bonus (5 points)
-    skills_count = len(data.get("skills", []))
-    if skills_count >= 10:
-        score += 5
-    elif skills_count >= 5:
-        score += 2
+    score += SKILL_DENSITY_BONUS[bisect.bisect_right(SKILL_DENSITY_BANDS, skills_count)]
     
     # Ensure score is within bounds
     score = max(0, min(100, round(score, 1)))
     
-    # Prepare detailed analysis
-    skills = data.get("skills", [])
-    work_experience = data.get("workExperience", [])
-    education = data.get("education", [])
-    
     return {
         "score": score,
         "sections_found": sections_found,
+        # Per-section entry counts, so later steps don't re-measure the lists
+        "counts": {name: len(items) for name, items in section_items.items()},
         "has_contact_info": has_contact_info,
         "skills_analysis": {
-            "total_skills": len(skills),
-            "top_skills": [skill.get("name") for skill in skills[:10] if skill.get("name")],
-            "skills_found": [skill.get("name") for skill in skills if skill.get("name")]
+            "total_skills": skills_count,
+            "top_skills": skill_names[:10],
+            "skills_found": skill_names
         },
         "experience_analysis": {
             "total_years": experience_years,
@@ -175,25 +373,92 @@ def calculate_ats_score_from_affinda(affinda_data: dict):
         "note": "ATS scoring based on Affinda parsed data"
     }
 
+# --- Resume Summary from Affinda Data ---
+def _first(items, default=None):
+    return items[0] if items else default
+
+def summarize_affinda_data(affinda_data: dict, score_data: dict):
+    """
+    Read the fields shared by the prompt, the report and the response once
+    """
+    counts = score_data["counts"]
+    return {
+        "name": (affinda_data.get("name") or {}).get("raw"),
+        "email": _first(affinda_data.get("emails")),
+        "phone": _first(affinda_data.get("phoneNumbers")),
+        "experience_years": affinda_data.get("totalYearsExperience", 0),
+        "education_count": counts["education"],
+        "experience_count": counts["experience"],
+        "skills_count": counts["skills"]
+    }
+
+def _with_placeholders(summary: dict, placeholder: str):
+    # Missing text fields show the placeholder; counts are shown as they are
+    return {**summary, **{key: summary[key] or placeholder for key in ("name", "email", "phone")}}
+
+# --- Gemini Model Resolution ---
+# Model names to try, in order of preference
+GEMINI_MODEL_CANDIDATES = [
+    'gemini-1.5-pro',
+    'gemini-1.0-pro',
+    'gemini-pro',
+    'models/gemini-pro'
+]
+_gemini_model = None
+_gemini_model_lock = asyncio.Lock()
+
+# list_models() is a network round-trip; /health and discovery share one
+# result that is refreshed at most once per TTL
+GEMINI_MODELS_TTL = 60
+_gemini_models_cache = {"ts": float("-inf"), "models": []}
+
+async def list_gemini_model_names():
+    now = time.monotonic()
+    if now - _gemini_models_cache["ts"] < GEMINI_MODELS_TTL:
+        return _gemini_models_cache["models"]
+    models = await asyncio.to_thread(lambda: [model.name for model in genai.list_models()])
+    _gemini_models_cache.update(ts=now, models=models)
+    return models
+
+async def get_gemini_model():
+    """
+    Resolve a working Gemini model once and reuse it for every request
+    """
+    global _gemini_model
+    if _gemini_model is not None:
+        return _gemini_model
+
+    async with _gemini_model_lock:
+        # Another request may have resolved it while we waited
+        if _gemini_model is None:
+            try:
+                model_names = await list_gemini_model_names()
+                logger.info("Available Gemini models: %s", model_names)
+                for model_name in GEMINI_MODEL_CANDIDATES:
+                    if any(model_name in name for name in model_names):
+                        _gemini_model = genai.GenerativeModel(model_name)
+                        logger.info("✅ Using Gemini model: %s", model_name)
+                        break
+            except Exception as e:
+                # Left unresolved so the next request retries discovery
+                logger.warning("Gemini model discovery failed: %s", e)
+    return _gemini_model
+
 # --- AI Enhancement with Working Gemini Models ---
-def enhance_resume_with_gemini(affinda_data: dict, ats_score: float, job_description: str = None):
-    if not GEMINI_API_KEY:
-        return "AI enhancement not available - Gemini API key missing"
-    
-    try:
-        # Prepare structured data for AI enhancement
-        resume_info = f"""
+RESUME_INFO_TEMPLATE = """
         Resume Analysis from Affinda:
-        - Name: {affinda_data.get('name', {}).get('raw', 'Not found')}
-        - Email: {affinda_data.get('emails', ['Not found'])[0] if affinda_data.get('emails') else 'Not found'}
-        - Phone: {affinda_data.get('phoneNumbers', ['Not found'])[0] if affinda_data.get('phoneNumbers') else 'Not found'}
-        - Education: {len(affinda_data.get('education', []))} institutions found
-        - Experience: {len(affinda_data.get('workExperience', []))} positions, {affinda_data.get('totalYearsExperience', 0)} years
-        - Skills: {len(affinda_data.get('skills', []))} skills identified
+        - Name: {name}
+        - Email: {email}
+        - Phone: {phone}
+        - Education: {education_count} institutions found
+        - Experience: {experience_count} positions, {experience_years} years
+        - Skills: {skills_count} skills identified
         - Current ATS Score: {ats_score}/100
         """
-        
-        prompt = f"""As an expert ATS resume optimizer, analyze this resume data and provide specific recommendations:
+
+# The instructions are fixed; only the resume block and score vary per call,
+# so the prompt keeps an identical prefix across requests
+ENHANCEMENT_PROMPT_TEMPLATE = """As an expert ATS resume optimizer, analyze this resume data and provide specific recommendations:
 
         {resume_info}
 
@@ -207,170 +472,425 @@ def enhance_resume_with_gemini(affinda_data: dict, ats_score: float, job_descrip
 
         Focus on actionable, specific recommendations.
         """
-        
-        if job_description:
-            prompt += f"\nTARGET JOB DESCRIPTION:\n{job_description}\n\nTailor recommendations for this role."
 
-        # Get available models and find a working one
-        try:
-            available_models = genai.list_models()
-            model_names = [model.name for model in available_models]
-            print(f"Available Gemini models: {model_names}")
-            
-            # Try different model names that might work
-            possible_models = [
-                'gemini-1.5-pro',
-                'gemini-1.0-pro',
-                'gemini-pro',
-                'models/gemini-pro'
-            ]
-            
-            working_model = None
-            for model_name in possible_models:
-                if any(model_name in name for name in model_names):
-                    try:
-                        model = genai.GenerativeModel(model_name)
-                        # Test with a short prompt
-                        test_response = model.generate_content("Hello", request_options={"timeout": 10})
-                        working_model = model
-                        print(f"✅ Using Gemini model: {model_name}")
-                        break
-                    except Exception as e:
-                        print(f"❌ Model {model_name} test failed: {e}")
-                        continue
-            
-            if not working_model:
-                return "AI enhancement not available - No working Gemini models found"
-            
-            # Generate the actual response
-            response = working_model.generate_content(prompt)
-            return response.text.strip()
-            
-        except Exception as e:
-            print(f"Gemini model discovery failed: {e}")
-            return f"AI enhancement failed: {str(e)}"
+JOB_DESCRIPTION_TEMPLATE = "\nTARGET JOB DESCRIPTION:\n{job_description}\n\nTailor recommendations for this role."
+
+def build_enhancement_prompt(summary: dict, ats_score: float, job_description: str = None):
+    # Prepare structured data for AI enhancement
+    resume_info = RESUME_INFO_TEMPLATE.format(**_with_placeholders(summary, "Not found"), ats_score=ats_score)
+
+    prompt = ENHANCEMENT_PROMPT_TEMPLATE.format(resume_info=resume_info, ats_score=ats_score)
+    if job_description:
+        prompt += JOB_DESCRIPTION_TEMPLATE.format(job_description=job_description)
+    return prompt
+
+@retry(
+    stop=stop_after_attempt(MAX_API_ATTEMPTS),
+    wait=_backoff,
+    retry=retry_if_exception_type(GEMINI_RETRY_ERRORS),
+    reraise=True
+)
+async def _generate_content(model, prompt: str, stream: bool = False):
+    # When streaming only opening the stream is retried; once text has been
+    # sent to the client a failure can't be replayed transparently
+    return await model.generate_content_async(prompt, stream=stream)
+
+async def enhance_resume_with_gemini(summary: dict, ats_score: float, job_description: str = None):
+    if not GEMINI_API_KEY:
+        return "AI enhancement not available - Gemini API key missing"
+    
+    try:
+        prompt = build_enhancement_prompt(summary, ats_score, job_description)
+
+        model = await get_gemini_model()
+        if not model:
+            return "AI enhancement not available - No working Gemini models found"
+
+        async with _gemini_semaphore:
+            response = await _generate_content(model, prompt)
+        return response.text.strip()
         
     except Exception as e:
-        print(f"Gemini API error: {e}")
+        logger.error("Gemini API error: %s", e)
         return f"AI enhancement failed: {str(e)}"
 
-# --- Save Analysis Report ---
-def save_analysis_report(affinda_data: dict, ats_score: float, recommendations: str, output_path: str):
+async def stream_resume_enhancement(summary: dict, ats_score: float, job_description: str = None):
+    """
+    Yield the Gemini recommendations piece by piece as they are generated
+    """
+    if not GEMINI_API_KEY:
+        yield "AI enhancement not available - Gemini API key missing"
+        return
+
     try:
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write("RESUME ATS ANALYSIS REPORT\n")
-            f.write("=" * 40 + "\n\n")
-            
-            f.write("RESUME SUMMARY:\n")
-            f.write("-" * 20 + "\n")
-            f.write(f"Name: {affinda_data.get('name', {}).get('raw', 'N/A')}\n")
-            f.write(f"Email: {affinda_data.get('emails', ['N/A'])[0] if affinda_data.get('emails') else 'N/A'}\n")
-            f.write(f"ATS Score: {ats_score}/100\n")
-            f.write(f"Experience: {affinda_data.get('totalYearsExperience', 0)} years\n")
-            f.write(f"Education: {len(affinda_data.get('education', []))} entries\n")
-            f.write(f"Skills: {len(affinda_data.get('skills', []))} identified\n\n")
-            
-            f.write("AI OPTIMIZATION RECOMMENDATIONS:\n")
-            f.write("-" * 35 + "\n")
-            f.write(recommendations if recommendations else "AI recommendations not available at this time.")
-            
-        return True
+        prompt = build_enhancement_prompt(summary, ats_score, job_description)
+
+        model = await get_gemini_model()
+        if not model:
+            yield "AI enhancement not available - No working Gemini models found"
+            return
+
+        async with _gemini_semaphore:
+            response = await _generate_content(model, prompt, stream=True)
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+
     except Exception as e:
-        print(f"File creation failed: {e}")
-        return False
+        logger.error("Gemini API error: %s", e)
+        yield f"AI enhancement failed: {str(e)}"
+
+# --- Build Analysis Report ---
+ANALYSIS_REPORT_TEMPLATE = (
+    "RESUME ATS ANALYSIS REPORT\n"
+    + "=" * 40 + "\n\n"
+    "RESUME SUMMARY:\n"
+    + "-" * 20 + "\n"
+    "Name: {name}\n"
+    "Email: {email}\n"
+    "ATS Score: {ats_score}/100\n"
+    "Experience: {experience_years} years\n"
+    "Education: {education_count} entries\n"
+    "Skills: {skills_count} identified\n\n"
+    "AI OPTIMIZATION RECOMMENDATIONS:\n"
+    + "-" * 35 + "\n"
+    "{recommendations}"
+)
+
+def build_analysis_report(summary: dict, ats_score: float, recommendations: str):
+    return ANALYSIS_REPORT_TEMPLATE.format(
+        **_with_placeholders(summary, "N/A"),
+        ats_score=ats_score,
+        recommendations=recommendations or "AI recommendations not available at this time."
+    )
+
+# --- Analysis Report Store ---
+# Reports are written to a shared temp directory under a random id, so a
+# download can be served by any uvicorn worker, not just the one that ran
+# the analysis. The helpers do blocking file I/O; async callers run them
+# with asyncio.to_thread
+REPORT_DIR = os.path.join(tempfile.gettempdir(), "ats_reports")
+REPORT_TTL_SECONDS = 1800
+REPORT_SWEEP_INTERVAL_SECONDS = 300
+REPORT_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+def _ensure_report_dir():
+    # Reports carry names and emails, so the directory is private to this
+    # user; chmod fails loudly if someone else already owns the path
+    os.makedirs(REPORT_DIR, mode=0o700, exist_ok=True)
+    os.chmod(REPORT_DIR, 0o700)
+
+_ensure_report_dir()
+
+def _report_path(report_id: str):
+    return os.path.join(REPORT_DIR, f"{report_id}.txt")
+
+def store_report(report: str):
+    report_id = uuid.uuid4().hex
+    # mkstemp creates the file 0600; writing then renaming means another
+    # worker never reads a half-written report
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=REPORT_DIR, suffix=".tmp")
+    except FileNotFoundError:
+        # A tmp cleaner removed the directory; put it back
+        _ensure_report_dir()
+        fd, tmp_path = tempfile.mkstemp(dir=REPORT_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(report)
+    os.replace(tmp_path, _report_path(report_id))
+    return report_id
+
+def stat_report(report_id: str):
+    """
+    Return (path, stat_result) for a live report, or None if it is unknown or expired
+    """
+    # Ids come from the URL, so anything that isn't one of ours is rejected
+    # before it can be used as a path
+    if not REPORT_ID_RE.fullmatch(report_id):
+        return None
+    path = _report_path(report_id)
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if stat_result.st_mtime + REPORT_TTL_SECONDS < time.time():
+        return None
+    return path, stat_result
+
+def sweep_expired_reports():
+    cutoff = time.time() - REPORT_TTL_SECONDS
+    try:
+        entries = os.scandir(REPORT_DIR)
+    except FileNotFoundError:
+        # Nothing to sweep; store_report recreates the directory when needed
+        return
+    with entries:
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                # Every worker sweeps; another one got there first
+                pass
+
+async def sweep_reports_periodically():
+    while True:
+        await asyncio.sleep(REPORT_SWEEP_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(sweep_expired_reports)
+        except OSError as e:
+            # Keep sweeping on the next tick rather than letting the task die
+            logger.warning("Report sweep failed: %s", e)
+
+# Markers of the fallback messages returned by enhance_resume_with_gemini,
+# matched in a single case-insensitive pass over the recommendations
+PARSE_FAILED_RECOMMENDATIONS = "AI enhancement skipped - resume parsing failed"
+RECOMMENDATION_FAILURE_RE = re.compile(r"failed|not available|error", re.IGNORECASE)
+
+def recommendations_available(recommendations: str):
+    return bool(recommendations and not RECOMMENDATION_FAILURE_RE.search(recommendations))
+
+# --- Analysis Pipeline ---
+async def compute_analysis(digest: str, filename: str, content: bytes, job_description: str = None):
+    """
+    Run Affinda parsing, scoring and Gemini recommendations for one resume,
+    reusing the result for byte-identical uploads with the same job description
+    """
+    cache_key = (digest, job_description)
+    cached = _cache_get(_analysis_cache, cache_key)
+    if cached is not None:
+        logger.info("Using cached analysis for identical upload")
+        return cached
+
+    affinda_data, score_data, summary = await parse_and_score(digest, filename, content)
+
+    # Get AI recommendations; a failed parse leaves nothing worth prompting on
+    if "error" in affinda_data:
+        logger.warning("Skipping AI recommendations: %s", affinda_data["error"])
+        recommendations = PARSE_FAILED_RECOMMENDATIONS
+    else:
+        logger.info("Generating AI recommendations for %s", filename)
+        recommendations = await enhance_resume_with_gemini(summary, score_data["score"], job_description)
+
+    analysis = (score_data, summary, recommendations)
+    # Failed runs are not cached so a retry reaches the APIs again
+    if "error" not in affinda_data and recommendations_available(recommendations):
+        _cache_put(_analysis_cache, cache_key, analysis)
+    return analysis
+
+async def parse_and_score(digest: str, filename: str, content: bytes):
+    # Parse resume with Affinda
+    logger.info("Parsing resume %s with Affinda API", filename)
+    affinda_data = await parse_resume_with_affinda(filename, content, digest)
+
+    # Calculate ATS score from Affinda data
+    logger.info("Calculating ATS score for %s", filename)
+    score_data = calculate_ats_score_from_affinda(affinda_data)
+    summary = summarize_affinda_data(affinda_data, score_data)
+    return affinda_data, score_data, summary
+
+def _sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+async def stream_analysis_events(digest: str, filename: str, content: bytes, job_description: str = None):
+    """
+    Same pipeline as compute_analysis, sent as server-sent events: the score
+    first, then recommendation text as Gemini produces it, then the report link
+    """
+    try:
+        cache_key = (digest, job_description)
+        cached = _cache_get(_analysis_cache, cache_key)
+        if cached is not None:
+            logger.info("Using cached analysis for identical upload")
+            score_data, summary, recommendations = cached
+            yield _sse_event("analysis", build_score_fields(score_data, summary))
+            yield _sse_event("token", {"token": recommendations})
+        else:
+            affinda_data, score_data, summary = await parse_and_score(digest, filename, content)
+            yield _sse_event("analysis", build_score_fields(score_data, summary))
+
+            if "error" in affinda_data:
+                logger.warning("Skipping AI recommendations: %s", affinda_data["error"])
+                recommendations = PARSE_FAILED_RECOMMENDATIONS
+                yield _sse_event("token", {"token": recommendations})
+            else:
+                logger.info("Streaming AI recommendations for %s", filename)
+                parts = []
+                async for token in stream_resume_enhancement(summary, score_data["score"], job_description):
+                    parts.append(token)
+                    yield _sse_event("token", {"token": token})
+                recommendations = "".join(parts).strip()
+                if recommendations_available(recommendations):
+                    _cache_put(_analysis_cache, cache_key, (score_data, summary, recommendations))
+
+        report_id = await asyncio.to_thread(store_report, build_analysis_report(summary, score_data["score"], recommendations))
+        yield _sse_event("done", {
+            "ai_recommendations_available": recommendations_available(recommendations),
+            "analysis_report_url": f"/download/{report_id}"
+        })
+
+    except Exception as e:
+        logger.exception("❌ Error streaming resume analysis")
+        yield _sse_event("error", {"error": f"Analysis failed: {str(e)}"})
+
+def build_score_fields(score_data: dict, summary: dict):
+    return {
+        "success": True,
+        "ats_score": score_data["score"],
+        "score_provider": "Affinda API + Custom ATS Algorithm",
+        "resume_analysis": summary,
+        "ats_breakdown": {
+            "sections_found": score_data.get("sections_found", []),
+            "has_contact_info": score_data.get("has_contact_info", False),
+            "skills_analysis": score_data.get("skills_analysis", {}),
+            "experience_analysis": score_data.get("experience_analysis", {}),
+            "education_analysis": score_data.get("education_analysis", {})
+        },
+        "note": score_data.get("note", "Analysis complete")
+    }
 
 # --- FastAPI Endpoints ---
+MAX_PDF_BYTES = 10 * 1024 * 1024
+UPLOAD_TOO_LARGE = f"PDF exceeds the {MAX_PDF_BYTES // (1024 * 1024)} MB upload limit"
+
+@app.on_event("startup")
+async def start_report_sweeper():
+    app.state.report_sweeper = asyncio.create_task(sweep_reports_periodically())
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    app.state.report_sweeper.cancel()
+    await AFFINDA_CLIENT.aclose()
+
 @app.get("/")
 async def root():
     return {"message": "AI Resume ATS Analyzer API with Affinda Integration"}
 
+async def read_pdf_upload(file: UploadFile):
+    """
+    Read and validate a PDF upload; returns (digest, content, error) where
+    error is a (message, status_code) pair for rejected files
+    """
+    if not file.filename.lower().endswith('.pdf'):
+        return None, None, ("Only PDF files are supported", 400)
+
+    # Read the upload in 64 KiB chunks, hashing as we go so identical
+    # uploads hit the caches. Affinda only needs the bytes, so the
+    # upload is kept in memory rather than written to a tempfile.
+    if file.size is not None and file.size > MAX_PDF_BYTES:
+        return None, None, (UPLOAD_TOO_LARGE, 413)
+    upload_hash = new_digest()
+    buffer = io.BytesIO()
+    while chunk := await file.read(1 << 16):
+        buffer.write(chunk)
+        # The declared size is optional, so enforce the cap while reading too
+        if buffer.tell() > MAX_PDF_BYTES:
+            return None, None, (UPLOAD_TOO_LARGE, 413)
+        upload_hash.update(chunk)
+    if buffer.tell() == 0:
+        return None, None, ("Uploaded file is empty", 400)
+    return upload_hash.hexdigest(), buffer.getvalue(), None
+
+async def build_analysis_response(digest: str, filename: str, content: bytes, job_description: str = None):
+    score_data, summary, recommendations = await compute_analysis(digest, filename, content, job_description)
+
+    # Save analysis results
+    report_id = await asyncio.to_thread(store_report, build_analysis_report(summary, score_data["score"], recommendations))
+
+    # Prepare response
+    response_data = build_score_fields(score_data, summary)
+    note = response_data.pop("note")
+    response_data.update({
+        "ai_recommendations_available": recommendations_available(recommendations),
+        "analysis_report_url": f"/download/{report_id}",
+        "note": note
+    })
+    return response_data
+
 @app.post("/analyze_resume/")
-async def analyze_resume(file: UploadFile = File(...), job_description: str = Form(None)):
+async def analyze_resume(file: UploadFile = File(...), job_description: str = Form(None), stream: bool = Form(False)):
     try:
-        if not file.filename.lower().endswith('.pdf'):
-            return JSONResponse({"error": "Only PDF files are supported"}, status_code=400)
-
-        # Save uploaded file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            content = await file.read()
-            if len(content) == 0:
-                return JSONResponse({"error": "Uploaded file is empty"}, status_code=400)
-            tmp.write(content)
-            input_pdf = tmp.name
-
-        # Parse resume with Affinda
-        print("Parsing resume with Affinda API...")
-        affinda_data = parse_resume_with_affinda(input_pdf)
-        
-        # Calculate ATS score from Affinda data
-        print("Calculating ATS score...")
-        score_data = calculate_ats_score_from_affinda(affinda_data)
-
-        # Get AI recommendations
-        print("Generating AI recommendations...")
-        recommendations = enhance_resume_with_gemini(affinda_data, score_data["score"], job_description)
-
-        # Save analysis results
-        enhanced_file = tempfile.NamedTemporaryFile(delete=False, suffix=".txt").name
-        save_success = save_analysis_report(
-            affinda_data, 
-            score_data["score"], 
-            recommendations, 
-            enhanced_file
-        )
+        digest, content, error = await read_pdf_upload(file)
+        if error:
+            message, status_code = error
+            return ORJSONResponse({"error": message}, status_code=status_code)
 
-        # Prepare response
-        response_data = {
-            "success": True,
-            "ats_score": score_data["score"],
-            "score_provider": "Affinda API + Custom ATS Algorithm",
-            "resume_analysis": {
-                "name": affinda_data.get("name", {}).get("raw"),
-                "email": affinda_data.get("emails", [None])[0],
-                "phone": affinda_data.get("phoneNumbers", [None])[0],
-                "experience_years": affinda_data.get("totalYearsExperience", 0),
-                "education_count": len(affinda_data.get("education", [])),
-                "experience_count": len(affinda_data.get("workExperience", [])),
-                "skills_count": len(affinda_data.get("skills", []))
-            },
-            "ats_breakdown": {
-                "sections_found": score_data.get("sections_found", []),
-                "has_contact_info": score_data.get("has_contact_info", False),
-                "skills_analysis": score_data.get("skills_analysis", {}),
-                "experience_analysis": score_data.get("experience_analysis", {}),
-                "education_analysis": score_data.get("education_analysis", {})
-            },
-            "ai_recommendations_available": bool(recommendations and 
-                "failed" not in recommendations.lower() and 
-                "not available" not in recommendations.lower() and
-                "error" not in recommendations.lower()),
-            "analysis_report_url": f"/download/{Path(enhanced_file).name}" if save_success else None,
-            "note": score_data.get("note", "Analysis complete")
-        }
+        # Opt-in: stream recommendations as they are generated instead of
+        # waiting for the whole Gemini response
+        if stream:
+            return StreamingResponse(
+                stream_analysis_events(digest, file.filename, content, job_description),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache"}
+            )
 
-        # Cleanup
+        return ORJSONResponse(await build_analysis_response(digest, file.filename, content, job_description))
+
+    except Exception as e:
+        logger.exception("❌ Error analyzing resume")
+        return ORJSONResponse({"error": f"Analysis failed: {str(e)}"}, status_code=500)
+
+# --- Batch Analysis ---
+MAX_BATCH_FILES = 20
+BATCH_MAX_CONCURRENCY = 10
+_batch_semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+async def _analyze_one(file: UploadFile, job_description: str = None):
+    # Each file reports its own outcome so one bad upload doesn't sink the
+    # batch; every entry carries success and the status /analyze_resume/
+    # would have returned for that file
+    async with _batch_semaphore:
         try:
-            os.unlink(input_pdf)
-        except:
-            pass
+            digest, content, error = await read_pdf_upload(file)
+            if error:
+                message, status_code = error
+                return _batch_error(file.filename, message, status_code)
+            response_data = await build_analysis_response(digest, file.filename, content, job_description)
+            return {"filename": file.filename, "status_code": 200, **response_data}
+        except Exception as e:
+            logger.exception("❌ Error analyzing %s", file.filename)
+            return _batch_error(file.filename, f"Analysis failed: {str(e)}", 500)
 
-        return JSONResponse(response_data)
+def _batch_error(filename: str, message: str, status_code: int):
+    return {"filename": filename, "success": False, "status_code": status_code, "error": message}
 
-    except Exception as e:
-        import traceback
-        print("❌ Error analyzing resume:")
-        traceback.print_exc()
-        return JSONResponse({"error": f"Analysis failed: {str(e)}"}, status_code=500)
+@app.post("/analyze_resumes/")
+async def analyze_resumes(files: List[UploadFile] = File(...), job_description: str = Form(None)):
+    if len(files) > MAX_BATCH_FILES:
+        return ORJSONResponse({"error": f"At most {MAX_BATCH_FILES} files per batch"}, status_code=400)
+
+    # Affinda and Gemini calls for all files run concurrently over the shared client
+    results = await asyncio.gather(*(_analyze_one(file, job_description) for file in files))
+    return ORJSONResponse({
+        "success": True,
+        "count": len(results),
+        "results": results
+    })
 
-@app.get("/download/{filename}")
-async def download_file(filename: str):
+@app.get("/download/{report_id}")
+async def download_file(report_id: str, request: Request):
     try:
-        file_path = os.path.join(tempfile.gettempdir(), filename)
-        if not os.path.exists(file_path):
-            return JSONResponse({"error": "File not found or expired"}, status_code=404)
-        return FileResponse(file_path, media_type="text/plain", filename="resume_analysis.txt")
+        report = await asyncio.to_thread(stat_report, report_id)
+        if report is None:
+            return ORJSONResponse({"error": "File not found or expired"}, status_code=404)
+        path, stat_result = report
+
+        # A report never changes once stored, so its id is a stable ETag
+        etag = f'"{report_id}"'
+        cache_headers = {"ETag": etag, "Cache-Control": "private, max-age=300"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=cache_headers)
+        # Passing the stat we already took saves FileResponse a second one,
+        # and the body is sent straight from the file
+        return FileResponse(
+            path,
+            media_type="text/plain",
+            filename="resume_analysis.txt",
+            stat_result=stat_result,
+            headers=cache_headers
+        )
     except Exception as e:
-        return JSONResponse({"error": str(e)}, status_code=500)
+        return ORJSONResponse({"error": str(e)}, status_code=500)
 
 @app.get("/health")
 async def health_check():
@@ -383,13 +903,12 @@ async def health_check():
     
     if GEMINI_API_KEY:
         try:
-            models = genai.list_models()
-            available_models = [model.name for model in models]
+            available_models = await list_gemini_model_names()
             gemini_models = [name for name in available_models if 'gemini' in name.lower()]
             gemini_models_working = len(gemini_models) > 0
-            print(f"Available Gemini models: {gemini_models}")
+            logger.info("Available Gemini models: %s", gemini_models)
         except Exception as e:
-            print(f"Gemini model check failed: {e}")
+            logger.warning("Gemini model check failed: %s", e)
     
     return {
         "status": "healthy", 
@@ -405,4 +924,13 @@ async def health_check():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    # Workers need the import string form so each one imports its own app
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        # uvloop has no Windows build, so stay on the stock loop there
+        loop="asyncio" if os.name == "nt" else "uvloop",
+        http="httptools"
+    )
\ No newline at end of file